@@ -1,74 +1,296 @@
 #!/usr/bin/env python
 
 import logging
-import http.client
+import binascii
+import hashlib
+import hmac
 import json
-import crypt
-import base64
-import difflib
+import os
+import re
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import responses as HTTP_RESPONSES
 
-from passlib.apache import HtpasswdFile
 from tornado import gen
-from tornado.web import RequestHandler, HTTPError, asynchronous
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.queues import Queue
+from tornado.web import RequestHandler, HTTPError, stream_request_body
 
 from cloudomate.config import config
 from cloudomate.scripts import create_collection
 from cloudomate.util import route
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
 log = logging.getLogger(__name__)
 
+# shared pool for blocking work that has to stay off the IOLoop
+_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get('CLOUDOMATE_THREAD_POOL_SIZE', 32)))
+
+# the parsed password file, shared by every request and re-read when it changes
+_HTPASSWD = None
+
+# recent authentication results, keyed by an hmac of the credentials
+AUTH_CACHE_TTL = 60
+AUTH_CACHE_SIZE = 1024
+_AUTH_CACHE = {}
+_AUTH_CACHE_KEY = secrets.token_bytes(32)
+
+# bumped whenever the password file changes, so a check that started against
+# the old file doesn't cache its answer
+_AUTH_GENERATION = 0
+
+# script output lines like "cloudomatethecloudgarage_return_value key=value" set a return value
+RETURN_VALUE_RE = re.compile(rb'cloudomatethecloudgarage_return_value\s*([^=]*?)\s*=\s*(.*?)\s*$')
+
+# responses always have the same shape, so they're filled in directly
+# rather than building and encoding a dict per request
+COMBINED_RESPONSE = b'{"stdout":%s,"return_values":%s,"retcode":%d}'
+SPLIT_RESPONSE = b'{"stdout":%s,"stderr":%s,"return_values":%s,"retcode":%d}'
+ERROR_RESPONSE = b'{"error":{"code":%d,"type":%s,"message":%s}}'
+OK_RESPONSE = b'{"status":"ok"}'
+
+# streamed scripts send one json object per line of output, then a final summary
+STREAM_LINE = b'{"stdout":%s}\n'
+STREAM_END = b'{"return_values":%s,"retcode":%d}\n'
+
+# lines of output a streamed script can get ahead of the client by
+STREAM_QUEUE_SIZE = 1024
+
+# streamed request bodies at least this large are parsed incrementally as they arrive
+STREAM_PARSE_THRESHOLD = 64 * 1024
+
+
+if orjson is not None:
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+else:
+    json_loads = json.loads
+
+    def json_dumps(value):
+        """ stdlib fallback for orjson.dumps, returning compact utf-8 bytes """
+        return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def invalidate_auth_cache():
+    """ forget every cached authentication result, including ones still being checked """
+
+    global _AUTH_GENERATION
+
+    _AUTH_GENERATION += 1
+    _AUTH_CACHE.clear()
+
+
+def expire_auth_cache(now):
+    """ drop expired authentication results, or everything if the cache is still full """
+
+    for tag, (_, expires) in list(_AUTH_CACHE.items()):
+        if expires <= now:
+            del _AUTH_CACHE[tag]
+
+    if len(_AUTH_CACHE) >= AUTH_CACHE_SIZE:
+        _AUTH_CACHE.clear()
+
+
+def decode_bytes(value):
+    """ recursively decode any bytes (e.g. script output lines) so the value can be json encoded """
+
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, dict):
+        return dict((key, decode_bytes(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [decode_bytes(item) for item in value]
+    return value
+
 
 class BaseHandler(RequestHandler):
     """ Contains helper methods for all request handlers """
 
-    def prepare(self):
+    # set on handlers decorated with @stream_request_body, whose params are
+    # only available after calling finish_params()
+    stream_params = False
+
+    # bytes of the streamed body received so far, stays 0 for bodiless requests
+    _body_size = 0
+
+    async def prepare(self):
+        # config can change after import, so read it once per request
+        self.force_json = config['force_json']
+        self.passfile = config['passfile']
+
+        # treat every request and response as json, whatever the content-type says
+        if self.force_json:
+            self.set_header("Content-Type", "application/json; charset=UTF-8")
+
         self.handle_params()
-        self.handle_auth()
+        await self.handle_auth()
 
     def handle_params(self):
         """ automatically parse the json body of the request """
 
         self.params = {}
-        content_type = self.request.headers.get("Content-Type", 'application/json')
 
-        if (content_type.startswith("application/json")) or (config['force_json']):
-            if self.request.body in [None, ""]:
+        # most requests have no body at all, so there's nothing to check
+        if self.stream_params:
+            headers = self.request.headers
+            if ("Transfer-Encoding" not in headers) and (headers.get("Content-Length", "0") == "0"):
                 return
+        elif not self.request.body:
+            return
 
-            self.params = json.loads(self.request.body)
-        else:
-            # we only handle json, and say so
+        # we only handle json, and say so
+        if not (self.force_json or self.request.headers.get("Content-Type", 'application/json').startswith("application/json")):
             raise HTTPError(400, "This application only support json, please set the http header Content-Type to application/json")
 
-    def handle_auth(self):
+        if self.stream_params:
+            self.start_params()
+        else:
+            self.params = json_loads(self.request.body)
+
+    def start_params(self):
+        """ get ready to receive a streamed json body """
+
+        self._body_size = 0
+        self._body = bytearray()
+        self._body_events = None
+        self._body_parser = None
+        self._body_error = None
+
+        # small bodies are buffered and parsed in one go, large (or chunked)
+        # ones are fed to ijson so the raw body is never held in memory
+        chunked = "Transfer-Encoding" in self.request.headers
+        content_length = int(self.request.headers.get("Content-Length", 0))
+        if ijson is not None and (chunked or content_length >= STREAM_PARSE_THRESHOLD):
+            self._body_events = ijson.sendable_list()
+            self._body_parser = ijson.items_coro(self._body_events, '', use_float=True)
+
+    def data_received(self, chunk):
+        """ collect or incrementally parse a streamed json body """
+
+        if self._finished or self._body_error is not None:
+            return
+
+        self._body_size += len(chunk)
+
+        if self._body_parser is None:
+            self._body += chunk
+            return
+
+        try:
+            self._body_parser.send(chunk)
+        except ijson.JSONError as e:
+            self._body_error = e
+
+    def finish_params(self):
+        """ build self.params from a streamed json body """
+
+        if self._body_size == 0:
+            return
+
+        if self._body_parser is not None:
+            try:
+                self._body_parser.close()
+            except ijson.JSONError as e:
+                self._body_error = e
+            if self._body_events:
+                self.params = self._body_events[0]
+        else:
+            # both orjson and json take the bytearray as is, without a bytes copy
+            try:
+                self.params = json_loads(self._body)
+            except ValueError as e:
+                self._body_error = e
+
+            # scripts can run for a while, don't hold on to the raw body
+            self._body = None
+
+        if self._body_error is not None:
+            raise HTTPError(400, "Could not parse the json body: {0}".format(self._body_error))
+
+    async def handle_auth(self):
         """ authenticate the user """
 
         # no passwords set, so they're good to go
-        if config['passfile'] == None:
+        if self.passfile is None:
             return
 
         # grab the auth header, returning a demand for the auth if needed
         auth_header = self.request.headers.get('Authorization')
-        if (auth_header is None) or (not auth_header.startswith('Basic ')):
+        if (auth_header is None) or (not auth_header.startswith('Basic ')) or (len(auth_header) < 10):
             self.auth_challenge()
             return
 
         # decode the username and password
-        auth_decoded = base64.decodestring(auth_header[6:])
-        username, password = auth_decoded.split(':', 2)
+        try:
+            auth_decoded = binascii.a2b_base64(auth_header[6:]).decode('utf-8')
+        except ValueError:
+            # covers bad base64, non-ascii header text and non-utf-8 credentials
+            self.auth_challenge()
+            return
+
+        username, _, password = auth_decoded.partition(':')
 
-        if not self.is_user_authenticated(username, password):
+        if not await self.is_user_authenticated(username, password):
             self.auth_challenge()
             return
 
-    def is_user_authenticated(self, username, password):
-        passfile = HtpasswdFile(config['passfile'])
+    async def is_user_authenticated(self, username, password):
+        passfile = self.load_passfile(self.passfile)
+
+        # checking a password is deliberately slow, so remember recent answers
+        # under a keyed hash of the credentials rather than the password itself
+        tag = hmac.new(_AUTH_CACHE_KEY, (username + ':' + password).encode('utf-8'), hashlib.sha256).digest()
+        now = time.monotonic()
+        cached = _AUTH_CACHE.get(tag)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        generation = _AUTH_GENERATION
 
         # is the user in the password file?
-        if not username in passfile.users():
-            return False
+        password_hash = passfile.get_hash(username)
+        if password_hash is None:
+            authenticated = False
+        else:
+            authenticated = bool(await IOLoop.current().run_in_executor(_EXECUTOR, passfile.context.verify, password, password_hash))
 
-        return passfile.check_password(username, password)
+        # the file may have been reloaded while we waited on the check
+        if generation != _AUTH_GENERATION:
+            return authenticated
+
+        if len(_AUTH_CACHE) >= AUTH_CACHE_SIZE:
+            expire_auth_cache(now)
+        _AUTH_CACHE[tag] = (authenticated, now + AUTH_CACHE_TTL)
+
+        return authenticated
+
+    def load_passfile(self, filename):
+        """ return the parsed password file, only re-reading it when it changes """
+
+        global _HTPASSWD
+
+        if _HTPASSWD is None or _HTPASSWD.path != filename:
+            # passlib is heavy, so only import it when a passfile is configured
+            from passlib.apache import HtpasswdFile
+
+            _HTPASSWD = HtpasswdFile(filename)
+            invalidate_auth_cache()
+        elif _HTPASSWD.load_if_changed():
+            # cached answers may be stale once the file changes
+            invalidate_auth_cache()
+
+        return _HTPASSWD
 
     def auth_challenge(self):
         """ return the standard basic auth challenge """
@@ -77,16 +299,21 @@ class BaseHandler(RequestHandler):
         self.set_status(401)
         self.finish()
 
+    def get_tags(self):
+        """ parse the comma separated tag filters from the query string """
+
+        args = self.request.query_arguments
+        return dict(
+            (tag_arg, self.decode_argument(args[tag_arg][0], name=tag_arg).strip().split(',') if tag_arg in args else [])
+            for tag_arg in ('tags', 'not_tags', 'any_tags')
+        )
+
     def write(self, chunk):
         """ if we get a dict, automatically change it to json and set the content-type """
 
         if isinstance(chunk, dict):
-            chunk = str(chunk)
-            chunk = chunk.replace("b'", '"')
-            chunk = chunk.replace("'", '"')
-            chunk = json.dumps(chunk)
-            chunk = json.loads(chunk.replace("\'", '"'))
             self.set_header("Content-Type", "application/json; charset=UTF-8")
+            chunk = json_dumps(decode_bytes(chunk))
         super(BaseHandler, self).write(chunk)
 
     def write_error(self, status_code, **kwargs):
@@ -98,13 +325,8 @@ class BaseHandler(RequestHandler):
             # TODO: What should go here?
             message = ''
 
-        self.write({
-            'error': {
-                'code': status_code,
-                'type': http.client.responses[status_code],
-                'message': message
-            }
-        })
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(ERROR_RESPONSE % (status_code, json_dumps(HTTP_RESPONSES.get(status_code, '')), json_dumps(message)))
 
 
 @route(r"/script_names/?")
@@ -113,15 +335,7 @@ class ScriptNamesCollectionHandler(BaseHandler):
     def get(self):
         """ get the requirements for all of the scripts """
 
-        tags = {'tags': [], 'not_tags': [], 'any_tags': []}
-
-        for tag_arg in ['tags', 'not_tags', 'any_tags']:
-            try:
-                tags[tag_arg] = self.get_arguments(tag_arg)[0].split(',')
-                break
-            except IndexError:
-                continue
-
+        tags = self.get_tags()
         self.finish({'script_names': self.settings['scripts'].name(tags)})
 
 
@@ -131,130 +345,107 @@ class ScriptCollectionHandler(BaseHandler):
     def get(self):
         """ get the requirements for all of the scripts """
 
-        tags = {'tags': [], 'not_tags': [], 'any_tags': []}
-
-        for tag_arg in ['tags', 'not_tags', 'any_tags']:
-            try:
-                tags[tag_arg] = self.get_arguments(tag_arg)[0].split(',')
-                break
-            except IndexError:
-                continue
-
+        tags = self.get_tags()
         self.finish({'scripts': self.settings['scripts'].metadata(tags)})
 
 
 @route(r"/scripts/([\w\-]+)/?")
+@stream_request_body
 class ScriptDetailsHandler(BaseHandler):
 
+    stream_params = True
+
     def options(self, script_name):
         """ get the requirements for this script """
 
         script = self.get_script(script_name, 'options')
         self.finish({'script': script.metadata()})
 
-    @asynchronous
-    @gen.engine
-    def get(self, script_name):
+    async def get(self, script_name):
         """ run the script """
+        await self.run_script(script_name, 'get')
 
-        if config['force_json']:
-            self.set_header("Content-Type", "application/json; charset=UTF-8")
+    async def delete(self, script_name):
+        """ run the script """
+        await self.run_script(script_name, 'delete')
 
-        script = self.get_script(script_name, 'get')
+    async def put(self, script_name):
+        """ run the script """
+        await self.run_script(script_name, 'put')
 
-        if script.output == 'combined':
-            retcode, stdout = yield gen.Task(script.execute, self.params)
-            self.finish({
-                "stdout": stdout,
-                "return_values": self.find_return_values(stdout),
-                "retcode": retcode
-            })
-        else:
-            retcode, stdout, stderr = yield gen.Task(script.execute, self.params)
-            self.finish({
-                "stdout": stdout,
-                "stderr": stderr,
-                "return_values": self.find_return_values(stdout),
-                "retcode": retcode
-            })
-
-    @asynchronous
-    @gen.engine
-    def delete(self, script_name):
+    async def post(self, script_name):
         """ run the script """
+        await self.run_script(script_name, 'post')
 
-        if config['force_json']:
-            self.set_header("Content-Type", "application/json; charset=UTF-8")
+    async def run_script(self, script_name, http_method):
+        """ run the script and return its output """
 
-        script = self.get_script(script_name, 'delete')
+        script = self.get_script(script_name, http_method)
+        self.finish_params()
+
+        if script.output == 'stream':
+            await self.stream_script(script)
+            return
 
         if script.output == 'combined':
-            retcode, stdout = yield gen.Task(script.execute, self.params)
-            self.finish({
-                "stdout": stdout,
-                "return_values": self.find_return_values(stdout),
-                "retcode": retcode
-            })
+            retcode, stdout = await script.execute(self.params)
+            body = COMBINED_RESPONSE % (
+                json_dumps(decode_bytes(stdout)),
+                json_dumps(self.find_return_values(stdout)),
+                retcode
+            )
         else:
-            retcode, stdout, stderr = yield gen.Task(script.execute, self.params)
-            self.finish({
-                "stdout": stdout,
-                "stderr": stderr,
-                "return_values": self.find_return_values(stdout),
-                "retcode": retcode
-            })
-
-    @asynchronous
-    @gen.engine
-    def put(self, script_name):
-        """ run the script """
+            retcode, stdout, stderr = await script.execute(self.params)
+            body = SPLIT_RESPONSE % (
+                json_dumps(decode_bytes(stdout)),
+                json_dumps(decode_bytes(stderr)),
+                json_dumps(self.find_return_values(stdout)),
+                retcode
+            )
 
-        if config['force_json']:
-            self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.finish(body)
 
-        script = self.get_script(script_name, 'put')
+    async def stream_script(self, script):
+        """ run the script, writing each line of output as soon as it's produced """
 
-        if script.output == 'combined':
-            retcode, stdout = yield gen.Task(script.execute, self.params)
-            self.finish({
-                "stdout": stdout,
-                "return_values": self.find_return_values(stdout),
-                "retcode": retcode,
-            })
-        else:
-            retcode, stdout, stderr = yield gen.Task(script.execute, self.params)
-            self.finish({
-                "stdout": stdout,
-                "stderr": stderr,
-                "return_values": self.find_return_values(stdout),
-                "retcode": retcode
-            })
-
-    @asynchronous
-    @gen.engine
-    def post(self, script_name):
-        """ run the script """
+        queue = Queue(maxsize=STREAM_QUEUE_SIZE)
+        execution = gen.convert_yielded(script.execute_stream(self.params, queue))
 
-        if config['force_json']:
-            self.set_header("Content-Type", "application/json; charset=UTF-8")
-
-        script = self.get_script(script_name, 'post')
+        self.set_header("Content-Type", "application/x-ndjson")
 
-        if script.output == 'combined':
-            retcode, stdout = yield gen.Task(script.execute, self.params)
-            self.finish({
-                "stdout": stdout,
-                "return_values": self.find_return_values(stdout),
-                "retcode": retcode
-            })
-        else:
-            retcode, stdout, stderr = yield gen.Task(script.execute, self.params)
-            self.finish({
-                "stdout": stdout,
-                "stderr": stderr,
-                "return_values": self.find_return_values(stdout),
-                "retcode": retcode
-            })
+        return_values = {}
+        connected = True
+
+        line = b''
+        try:
+            line = await queue.get()
+            while line is not None:
+                match = RETURN_VALUE_RE.match(line)
+                if match is not None:
+                    return_values[match.group(1).decode('utf-8', 'replace')] = match.group(2).decode('utf-8', 'replace')
+
+                if connected:
+                    self.write(STREAM_LINE % json_dumps(line.decode('utf-8', 'replace')))
+
+                    # only wait on the client once we've caught up with the script
+                    if queue.empty():
+                        try:
+                            await self.flush()
+                        except StreamClosedError:
+                            # keep draining the queue so the script isn't left blocked
+                            connected = False
+
+                line = await queue.get()
+        finally:
+            # however we got here, let the script run to the end so the child
+            # is reaped and its lock released
+            while line is not None:
+                line = await queue.get()
+            retcode = await execution
+
+        if connected:
+            self.finish(STREAM_END % (json_dumps(return_values), retcode))
 
     def get_script(self, script_name, http_method):
         script = self.settings['scripts'].get(script_name, None)
@@ -274,11 +465,10 @@ class ScriptDetailsHandler(BaseHandler):
         """ parse output array for return values """
         return_values = {}
         for line in output:
-            lineone = line.decode()
-            if lineone.startswith('cloudomatethecloudgarage_return_value'):
-                temp = lineone.replace("cloudomatethecloudgarage_return_value","").strip()
-                key, value = [item.strip() for item in temp.split('=')]
-                return_values[key] = value
+            # only matching lines are ever decoded
+            match = RETURN_VALUE_RE.match(line)
+            if match is not None:
+                return_values[match.group(1).decode('utf-8', 'replace')] = match.group(2).decode('utf-8', 'replace')
 
         return return_values
 
@@ -286,7 +476,11 @@ class ScriptDetailsHandler(BaseHandler):
 @route(r"/reload/?")
 class ReloadHandler(BaseHandler):
 
-    def post(self):
+    async def post(self):
         """ reload the scripts from the script directory """
-        self.settings['scripts'] = create_collection(config['directory'])
-        self.finish({"status": "ok"})
+        # walking and parsing the directory blocks, so build the new collection
+        # in the pool and swap it in once it's complete
+        scripts = await IOLoop.current().run_in_executor(_EXECUTOR, create_collection, config['directory'])
+        self.settings['scripts'] = scripts
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.finish(OK_RESPONSE)
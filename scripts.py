@@ -8,12 +8,15 @@ import re
 import subprocess
 
 from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.locks import Lock
 from tornado.process import Subprocess
-from tornado.ioloop import IOLoop
-import toro
 
 log = logging.getLogger(__name__)
 
+# how much output to read from a streaming script at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+
 
 class ScriptCollection(dict):
     """ load the collection of scripts """
@@ -77,7 +80,7 @@ class Script(object):
     """ a single script in the directory """
 
     def __init__(self, filename, name, description, params, filtered_params, tags, http_method, output, needs_lock):
-        self.lock = toro.Lock()
+        self.lock = Lock()
         self.filename = filename
         self.name = name
         self.description = description
@@ -95,20 +98,16 @@ class Script(object):
                 filtered_params[k] = 'FILTERED'
         return filtered_params
 
-    @gen.engine
-    def execute(self, params, callback):
+    async def execute(self, params):
         log.info("Executing script: {0} with params: {1}".format(self.filename, self.filter_params(params)))
 
         if self.needs_lock:
-            with (yield gen.Task(self.lock.aquire)):
-                response = yield gen.Task(self.do_execute, params)
-        else:
-            response = yield gen.Task(self.do_execute, params)
+            with (await self.lock.acquire()):
+                return await self.do_execute(params)
 
-        callback(response)
+        return await self.do_execute(params)
 
-    @gen.engine
-    def do_execute(self, params, callback):
+    async def do_execute(self, params):
         env = self.create_env(params)
 
         if self.output == 'combined':
@@ -116,32 +115,79 @@ class Script(object):
                     self.filename,
                     env=env,
                     stdout=Subprocess.STREAM,
-                    stderr=subprocess.STDOUT,
-                    io_loop=IOLoop.instance()
+                    stderr=subprocess.STDOUT
                 )
 
-            retcode, stdout = yield [
-                gen.Task(child.set_exit_callback),
-                gen.Task(child.stdout.read_until_close)
-            ]
+            retcode, stdout = await gen.multi([
+                child.wait_for_exit(raise_error=False),
+                child.stdout.read_until_close()
+            ])
 
-            callback((child.returncode, stdout.split()))
+            return (retcode, stdout.split())
         else:
             child = Subprocess(
                     self.filename,
                     env=env,
                     stdout=Subprocess.STREAM,
-                    stderr=Subprocess.STREAM,
-                    io_loop=IOLoop.instance()
+                    stderr=Subprocess.STREAM
                 )
 
-            retcode, stdout, stderr = yield [
-                gen.Task(child.set_exit_callback),
-                gen.Task(child.stdout.read_until_close),
-                gen.Task(child.stderr.read_until_close)
-            ]
+            retcode, stdout, stderr = await gen.multi([
+                child.wait_for_exit(raise_error=False),
+                child.stdout.read_until_close(),
+                child.stderr.read_until_close()
+            ])
+
+            return (retcode, stdout.splitlines(), stderr.splitlines())
+
+    async def execute_stream(self, params, queue):
+        """ run the script, putting each line of output on the queue as it's produced, then None """
+
+        log.info("Streaming script: {0} with params: {1}".format(self.filename, self.filter_params(params)))
+
+        try:
+            if self.needs_lock:
+                with (await self.lock.acquire()):
+                    return await self.do_execute_stream(params, queue)
+
+            return await self.do_execute_stream(params, queue)
+        finally:
+            await queue.put(None)
+
+    async def do_execute_stream(self, params, queue):
+        env = self.create_env(params)
 
-            callback((child.returncode, stdout.splitlines(), stderr.splitlines()))
+        child = Subprocess(
+                self.filename,
+                env=env,
+                stdout=Subprocess.STREAM,
+                stderr=subprocess.STDOUT
+            )
+
+        # read_until would lose a last line without a newline, so split lines here,
+        # only scanning newly read bytes so a very long line stays linear
+        pending = bytearray()
+        while True:
+            try:
+                chunk = await child.stdout.read_bytes(STREAM_CHUNK_SIZE, partial=True)
+            except StreamClosedError:
+                break
+
+            start = 0
+            pending += chunk
+            end = pending.find(b'\n', len(pending) - len(chunk))
+            while end != -1:
+                # a full queue holds the script up until the client catches up
+                await queue.put(bytes(pending[start:end]))
+                start = end + 1
+                end = pending.find(b'\n', start)
+
+            del pending[:start]
+
+        if pending:
+            await queue.put(bytes(pending))
+
+        return await child.wait_for_exit(raise_error=False)
 
     def create_env(self, input):
         output = {}
@@ -263,7 +309,7 @@ def create_script(script_name, filename):
 
         # output
         if in_block and key == "output":
-            if value.lower() in ['split','combined']:
+            if value.lower() in ['split','combined','stream']:
                 output = value.lower()
                 continue
             else: